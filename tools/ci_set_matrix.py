@@ -25,7 +25,9 @@ import re
 import os
 import sys
 import json
+import hashlib
 import pathlib
+import functools
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
 
@@ -36,14 +38,10 @@ sys.path.insert(0, str(tools_dir / "adabot"))
 sys.path.insert(0, str(top_dir / "docs"))
 
 import build_board_info
-from shared_bindings_matrix import (
-    get_settings_from_makefile,
-    SUPPORTED_PORTS,
-    all_ports_all_boards,
-)
 
 # Files that never influence board builds
-IGNORE_BOARD = {
+# (tuples of prefixes, so they can be passed to str.startswith directly)
+IGNORE_BOARD = (
     ".devcontainer",
     "conf.py",
     "docs",
@@ -51,15 +49,18 @@ IGNORE_BOARD = {
     "tools/ci_changes_per_commit.py",
     "tools/ci_check_duplicate_usb_vid_pid.py",
     "tools/ci_set_matrix.py",
-}
-
-PATTERN_DOCS = (
-    r"^(?:\.github|docs|extmod\/ulab)|"
-    r"^(?:(?:ports\/\w+\/bindings|shared-bindings)\S+\.c|tools\/extract_pyi\.py|\.readthedocs\.yml|conf\.py|requirements-doc\.txt)$|"
-    r"(?:-stubs|\.(?:md|MD|mk|rst|RST)|/Makefile)$"
 )
 
-PATTERN_WINDOWS = {
+# Files that influence the docs build
+PREFIX_DOCS = (".github", "docs", "extmod/ulab")
+FILES_DOCS = {"tools/extract_pyi.py", ".readthedocs.yml", "conf.py", "requirements-doc.txt"}
+SUFFIX_DOCS = ("-stubs", ".md", ".MD", ".mk", ".rst", ".RST", "/Makefile")
+PATTERN_DOCS_BINDINGS = re.compile(r"^(?:ports\/\w+\/bindings|shared-bindings)\S+\.c$")
+
+# Name of the file caching board settings between runs, stored under $RUNNER_TOOL_CACHE
+BOARD_SETTINGS_CACHE = "board_settings_cache.json"
+
+PATTERN_WINDOWS = (
     ".github/",
     "extmod/",
     "lib/",
@@ -68,7 +69,35 @@ PATTERN_WINDOWS = {
     "py/",
     "tools/",
     "requirements-dev.txt",
-}
+)
+
+
+# Split a path into the (port, board, module) it belongs to, each None if not applicable.
+# Matches `ports/<port>/`, `ports/<port>/boards/<board>/` and
+# `(ports/<port>/(common-hal|bindings)|shared-bindings|shared-module)/<module>/`
+def split_path(file: str):
+    parts = file.split("/", 4)
+    port = board = module = None
+    if len(parts) > 2 and parts[1]:
+        if parts[0] == "ports":
+            port = parts[1]
+            if len(parts) > 4 and parts[3]:
+                if parts[2] == "boards":
+                    board = parts[3]
+                elif parts[2] in ("common-hal", "bindings"):
+                    module = parts[3]
+        elif parts[0] in ("shared-bindings", "shared-module"):
+            module = parts[1]
+    return port, board, module
+
+
+def is_docs_file(file: str):
+    return (
+        file.startswith(PREFIX_DOCS)
+        or file.endswith(SUFFIX_DOCS)
+        or file in FILES_DOCS
+        or (file.endswith(".c") and PATTERN_DOCS_BINDINGS.search(file) is not None)
+    )
 
 
 def git_diff(pattern: str):
@@ -111,12 +140,137 @@ print_enclosed("Log: changed_files", changed_files)
 print_enclosed("Log: last_failed_jobs", last_failed_jobs)
 
 
+# Step outputs are collected here and written all at once by flush_outputs()
+pending_outputs = []
+
+
 def set_output(name: str, value):
+    pending_outputs.append((name, value))
+
+
+def flush_outputs():
     if "GITHUB_OUTPUT" in os.environ:
         with open(os.environ["GITHUB_OUTPUT"], "at") as f:
-            print(f"{name}={value}", file=f)
+            f.writelines(f"{name}={value}\n" for name, value in pending_outputs)
     else:
-        print(f"Would set GitHub actions output {name} to '{value}'")
+        print(
+            "\n".join(
+                f"Would set GitHub actions output {name} to '{value}'"
+                for name, value in pending_outputs
+            )
+        )
+    pending_outputs.clear()
+
+
+def get_board_settings(board: str, port: str):
+    # Only needed when some board settings have to be computed
+    from shared_bindings_matrix import get_settings_from_makefile
+
+    return board, get_settings_from_makefile(str(top_dir / "ports" / port), board)
+
+
+# Precompute what is checked against a board's settings for each changed file, so the
+# checks are set lookups instead of substring scans of the raw makefile values
+def prepare_board_settings(settings: dict, port: str):
+    port_dir = top_dir / "ports" / port
+    return {
+        **settings,
+        # FROZEN_MPY_DIRS entries are relative to the port directory, e.g. `../../frozen/X`.
+        # Keep them as `frozen/X/` so that `frozen/X` doesn't also match `frozen/X_extra/`.
+        "_frozen_dirs": tuple(
+            os.path.relpath(port_dir / path, top_dir) + "/"
+            for path in settings.get("FROZEN_MPY_DIRS", "").split()
+        ),
+        "_web_workflow": settings.get("CIRCUITPY_WEB_WORKFLOW", "0") != "0",
+        "_supervisor_set": frozenset(settings.get("SRC_SUPERVISOR", "").split()),
+        # SRC_PATTERNS entries look like `displayio/%` or `bitbangio/SPI%`
+        "_src_modules_set": frozenset(
+            pattern.split("/", 1)[0] + "/" for pattern in settings.get("SRC_PATTERNS", "").split()
+        ),
+    }
+
+
+# Files, besides a board's own directory, that the settings of a board are computed from:
+# shared_bindings_matrix.py (which chooses the variables printed) and every tracked makefile
+# under py/, extmod/, supervisor/ and ports/, including those in subdirectories
+@functools.cache
+def get_settings_inputs():
+    files = (
+        subprocess.run(
+            ["git", "ls-files", "-z", "--", "py", "extmod", "supervisor", "ports"],
+            cwd=top_dir,
+            capture_output=True,
+            check=True,
+        )
+        .stdout.decode("utf-8")
+        .split("\0")
+    )
+    makefiles = [file for file in files if file.endswith(".mk") or file.endswith("Makefile")]
+    return ["docs/shared_bindings_matrix.py"] + sorted(makefiles)
+
+
+# Missing files are hashed too, as supervisor.mk checks for some with $(wildcard ...)
+def hash_files(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        file = top_dir / path
+        content = file.read_bytes() if file.is_file() else b"<missing>"
+        digest.update(path.encode("utf-8") + b"\0" + content + b"\0")
+    return digest.hexdigest()
+
+
+@functools.cache
+def hash_port_settings_inputs(port: str):
+    port_prefix = f"ports/{port}/"
+    return hash_files(
+        [
+            path
+            for path in get_settings_inputs()
+            if not path.startswith("ports/")
+            or (path.startswith(port_prefix) and not path.startswith(port_prefix + "boards/"))
+        ]
+        + [port_prefix + "supervisor/serial.c", port_prefix + "supervisor/usb.c"]
+    )
+
+
+# The settings of a board only change when one of the files they are computed from does
+def get_board_settings_key(board: str, port: str):
+    board_dir = top_dir / "ports" / port / "boards" / board
+    board_files = [path.relative_to(top_dir).as_posix() for path in sorted(board_dir.glob("*.mk"))]
+    return hash_files(board_files) + hash_port_settings_inputs(port)
+
+
+# No caching when the settings are stubbed out by NO_BINDINGS_MATRIX
+def get_board_settings_cache_path():
+    cache_dir = os.environ.get("RUNNER_TOOL_CACHE")
+    if not cache_dir or os.environ.get("NO_BINDINGS_MATRIX"):
+        return None
+    return pathlib.Path(cache_dir) / BOARD_SETTINGS_CACHE
+
+
+def load_board_settings_cache():
+    cache_path = get_board_settings_cache_path()
+    if not cache_path or not cache_path.exists():
+        return {}
+    try:
+        cache = json.loads(cache_path.read_bytes())
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable board settings cache {cache_path}: {e}")
+        return {}
+    if not isinstance(cache, dict):
+        print(f"Ignoring malformed board settings cache {cache_path}")
+        return {}
+    return cache
+
+
+def save_board_settings_cache(cache: dict):
+    cache_path = get_board_settings_cache_path()
+    if not cache_path:
+        return
+    try:
+        cache_path.write_text(json.dumps(cache), encoding="utf-8")
+    except OSError as e:
+        print(f"Unable to save board settings cache {cache_path}: {e}")
 
 
 def set_boards(build_all: bool):
@@ -135,91 +289,145 @@ def set_boards(build_all: bool):
         board_to_port[id] = port
         port_to_board.setdefault(port, set()).add(id)
 
+    # Boards are only iterated from here on, so keep them as sorted tuples
+    all_board_ids_sorted = tuple(sorted(all_board_ids))
+    port_to_board = {port: tuple(sorted(boards)) for port, boards in port_to_board.items()}
+
     def compute_board_settings(boards):
-        need = set(boards) - set(board_setting.keys())
+        need = sorted(set(boards) - set(board_setting.keys()))
         if not need:
             return
 
-        def get_settings(board):
-            return (
-                board,
-                get_settings_from_makefile(str(top_dir / "ports" / board_to_port[board]), board),
-            )
-
-        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
-            board_setting.update(ex.map(get_settings, need))
+        # Reuse the settings of boards whose makefiles haven't changed since a previous run
+        use_cache = get_board_settings_cache_path() is not None
+        cache = load_board_settings_cache()
+        keys = {}
+        if use_cache:
+            keys = {board: get_board_settings_key(board, board_to_port[board]) for board in need}
+        settings = {}
+        for board in need:
+            # Entries in any other format, e.g. from an older version of this script, are misses
+            cached = cache.get(board)
+            if (
+                isinstance(cached, dict)
+                and cached.get("key") == keys[board]
+                and isinstance(cached.get("settings"), dict)
+            ):
+                settings[board] = cached["settings"]
+        need = [board for board in need if board not in settings]
+        print(f"Board settings cached: {len(settings)}, computing: {len(need)}")
+
+        if need:
+            # The work happens in the `make` subprocesses, which run in parallel outside the GIL
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                settings.update(
+                    ex.map(get_board_settings, need, [board_to_port[board] for board in need])
+                )
+
+            if use_cache:
+                for board in need:
+                    cache[board] = {"key": keys[board], "settings": settings[board]}
+                save_board_settings_cache(cache)
+
+        for board, raw_settings in settings.items():
+            board_setting[board] = prepare_board_settings(raw_settings, board_to_port[board])
+
+    # Files that need the makefile settings of some boards to decide, as (file, port, module)
+    settings_files = []
+    settings_boards = set()
 
     if not build_all:
-        pattern_port = re.compile(r"^ports/([^/]+)/")
-        pattern_board = re.compile(r"^ports/[^/]+/boards/([^/]+)/")
-        pattern_module = re.compile(
-            r"^(ports/[^/]+/(?:common-hal|bindings)|shared-bindings|shared-module)/([^/]+)/"
-        )
-
         for file in changed_files:
             if len(all_board_ids) == len(boards_to_build):
                 break
 
-            if any([file.startswith(path) for path in IGNORE_BOARD]):
+            if file.startswith(IGNORE_BOARD):
                 continue
 
+            port, board, module = split_path(file)
+
             # See if it is board specific
-            board_matches = pattern_board.search(file)
-            if board_matches:
-                boards_to_build.add(board_matches.group(1))
+            if board:
+                boards_to_build.add(board)
                 continue
 
             # See if it is port specific
-            port_matches = pattern_port.search(file)
-            module_matches = pattern_module.search(file)
-            port = port_matches.group(1) if port_matches else None
-            if port and not module_matches:
+            if port and not module:
                 if port != "unix":
                     boards_to_build.update(port_to_board[port])
                 continue
 
             # As a (nearly) last resort, for some certain files, we compute the settings from the
             # makefile for each board and determine whether to build them that way
-            if file.startswith("frozen") or file.startswith("supervisor") or module_matches:
-                boards = port_to_board[port] if port else all_board_ids
-                compute_board_settings(boards)
-
-                for board in boards:
-                    settings = board_setting[board]
+            if file.startswith("frozen") or file.startswith("supervisor") or module:
+                settings_files.append((file, port, module))
+                settings_boards.update(port_to_board[port] if port else all_board_ids_sorted)
+                continue
 
-                    # Check frozen files to see if they are in each board
-                    if file.startswith("frozen"):
-                        if file in settings["FROZEN_MPY_DIRS"]:
-                            boards_to_build.add(board)
-                            continue
+            # Otherwise build it all
+            build_all = True
+            break
 
-                    # Check supervisor files
-                    # This is useful for limiting workflow changes to the relevant boards
-                    if file.startswith("supervisor"):
-                        if file in settings["SRC_SUPERVISOR"]:
-                            boards_to_build.add(board)
-                            continue
+    # Decide on the cheap checks alone whether everything is built, so that no makefile
+    # settings are computed when they can't change the outcome
+    if build_all or len(all_board_ids) == len(boards_to_build):
+        boards_to_build = all_board_ids
+    elif settings_files:
+        # Boards already selected don't need their settings computed
+        settings_boards.difference_update(boards_to_build)
+        compute_board_settings(settings_boards)
+
+        # Many boards of a port enable the same modules, so group them by (port, modules)
+        # and check each group once per changed module instead of each board
+        modules_to_boards = {}
+        for board in sorted(settings_boards):
+            key = (board_to_port[board], board_setting[board]["_src_modules_set"])
+            modules_to_boards.setdefault(key, []).append(board)
+
+        for file, port, module in settings_files:
+            if len(all_board_ids) == len(boards_to_build):
+                break
 
-                        if file.startswith("supervisor/shared/web_workflow/static/"):
-                            web_workflow = settings["CIRCUITPY_WEB_WORKFLOW"]
+            # Check module matches
+            if module:
+                for (board_port, modules), boards in modules_to_boards.items():
+                    if (not port or board_port == port) and module + "/" in modules:
+                        boards_to_build.update(boards)
+                continue
 
-                            if web_workflow != "0":
-                                boards_to_build.add(board)
-                                continue
+            boards = port_to_board[port] if port else all_board_ids_sorted
+            for board in boards:
+                if board in boards_to_build:
+                    continue
 
-                    # Check module matches
-                    if module_matches:
-                        module = module_matches.group(2) + "/"
-                        if module in settings["SRC_PATTERNS"]:
+                settings = board_setting[board]
+
+                # Check frozen files to see if they are in each board
+                if file.startswith("frozen"):
+                    # A submodule is reported as `frozen/X`, files inside it as `frozen/X/...`.
+                    # Frozen dirs can also be nested inside a submodule, e.g.
+                    # `frozen/circuitpython-stage/pybadge/`, so a change to `frozen/X` must
+                    # match them too: match when either path is a prefix of the other.
+                    frozen_file = file + "/"
+                    if any(
+                        frozen_dir.startswith(frozen_file) or frozen_file.startswith(frozen_dir)
+                        for frozen_dir in settings["_frozen_dirs"]
+                    ):
+                        boards_to_build.add(board)
+                        continue
+
+                # Check supervisor files
+                # This is useful for limiting workflow changes to the relevant boards
+                if file.startswith("supervisor"):
+                    if file in settings["_supervisor_set"]:
+                        boards_to_build.add(board)
+                        continue
+
+                    if file.startswith("supervisor/shared/web_workflow/static/"):
+                        if settings["_web_workflow"]:
                             boards_to_build.add(board)
                             continue
 
-                continue
-
-            # Otherwise build it all
-            boards_to_build = all_board_ids
-            break
-
     # Append previously failed boards
     boards_to_build.update(last_failed_jobs.get("ports", []))
 
@@ -229,12 +437,12 @@ def set_boards(build_all: bool):
     port_to_boards_to_build = {}
 
     # Append boards according to job
-    for board in sorted(boards_to_build):
-        port = board_to_port.get(board)
-        # A board can appear due to its _deletion_ (rare)
-        # if this happens it's not in `board_to_port`.
-        if not port:
+    # A board can appear due to its _deletion_ (rare), if this happens it's not in
+    # `all_board_ids_sorted` and is skipped.
+    for board in all_board_ids_sorted:
+        if board not in boards_to_build:
             continue
+        port = board_to_port[board]
         port_to_boards_to_build.setdefault(port, []).append(board)
         print(" ", board)
 
@@ -250,11 +458,10 @@ def set_docs(run: bool):
         if last_failed_jobs.get("docs"):
             run = True
         else:
-            pattern_doc = re.compile(PATTERN_DOCS)
             github_workspace = os.environ.get("GITHUB_WORKSPACE") or ""
             github_workspace = github_workspace and github_workspace + "/"
             for file in changed_files:
-                if pattern_doc.search(file) and (
+                if is_docs_file(file) and (
                     (
                         subprocess.run(
                             rf"git diff -U0 $BASE_SHA...$HEAD_SHA {github_workspace + file} | grep -o -m 1 '^[+-]\/\/|'",
@@ -279,15 +486,9 @@ def set_windows(run: bool):
             run = True
         else:
             for file in changed_files:
-                for pattern in PATTERN_WINDOWS:
-                    if file.startswith(pattern) and not any(
-                        [file.startswith(path) for path in IGNORE_BOARD]
-                    ):
-                        run = True
-                        break
-                else:
-                    continue
-                break
+                if file.startswith(PATTERN_WINDOWS) and not file.startswith(IGNORE_BOARD):
+                    run = True
+                    break
 
     # Set the step outputs
     print("Building windows:", run)
@@ -301,6 +502,7 @@ def main():
     set_docs(run_all)
     set_windows(run_all)
     set_boards(run_all)
+    flush_outputs()
 
 
 if __name__ == "__main__":